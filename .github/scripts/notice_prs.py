@@ -1,111 +1,279 @@
 import os
 import requests
-import json
+import orjson
 import logging
 from pathlib import Path
-from typing import Any, Dict, List
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from operator import itemgetter
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ログの設定
 logging.basicConfig(level=logging.INFO)
 
 # 定数
 CONFIG_FILE_PATH = ".github/scripts/config.json"
+GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
+CONFIG_REQUIRED_FIELDS = ("owner_name", "repo_name", "target_label", "webhook_secret_name")
+get_config_fields = itemgetter(*CONFIG_REQUIRED_FIELDS)
 DEV_OPS_TOKEN = os.getenv("DEV_OPS_TOKEN")
+GITHUB_HEADERS = {"Authorization": f"token {DEV_OPS_TOKEN}", "Accept": "application/vnd.github+json", "Content-Type": "application/json"}
+SLACK_HEADERS = {"Content-Type": "application/json"}
 REVIEW_COMPLETE_LIMIT = 1
-REVIEW_STATUS_WAITING = "WAITING"
-REVIEW_STATUS_COMPLETE = "COMPLETE"
+# レートリミット到達時の再試行回数と、待機を許容する最大秒数
+RATE_LIMIT_RETRY_LIMIT = 3
+RATE_LIMIT_MAX_WAIT_SECONDS = 300
+# 残り回数がこの値を下回ったら、403 を受ける前にリセット時刻まで待機する
+RATE_LIMIT_REMAINING_THRESHOLD = 10
+# 応答のない接続でワークフロー全体が止まらないよう、すべての通信にタイムアウトを設定する
+REQUEST_TIMEOUT_SECONDS = 10
+# リポジトリ (Config) ごとの処理を並行して実行する際の最大スレッド数
+CONFIG_MAX_WORKERS = 8
 
+SLACK_MESSAGE_TEMPLATE = (
+    ":page_facing_up: [%s] プルリクエストレビュー状況\n\n"
+    "------------------------\n"
+    "*未レビュー ( %d 件 )*\n%s\n\n\n"
+    "*レビュー中 ( %d 件 )*\n%s"
+)
+SLACK_PR_LINE_TEMPLATE = "- <%s> ( approve: %d人, comment: %d人 )"
 
+# 対象ラベルが付いたオープンな PR と、そのレビューを 1 回のクエリでまとめて取得する
+# ラベルの絞り込みは GitHub 側で行うため、ラベル自体は取得しない
+# レビューは各ユーザーの最新状態を求めるため、新しい方から取得する
+PULL_REQUESTS_QUERY = """
+query($owner: String!, $name: String!, $label: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    pullRequests(states: OPEN, labels: [$label], first: 100, after: $cursor) {
+      nodes {
+        url
+        isDraft
+        author { login }
+        reviews(last: 100) { nodes { state author { login } } }
+      }
+      pageInfo { hasNextPage endCursor }
+    }
+  }
+}
+"""
+
+# GitHub / Slack への通信で TCP・TLS 接続を使い回すための共通セッション
+# Slack の Webhook にトークンを送らないよう、認証ヘッダーはセッションに持たせない
+SESSION = requests.Session()
+# 一時的な 5xx の再試行は GitHub API にのみ適用する
+SESSION.mount(
+    "https://api.github.com/",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,
+            backoff_jitter=1.0,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=["GET", "POST"],
+            # レートリミットの待機は request_github に任せる
+            respect_retry_after_header=False
+        )
+    )
+)
+
+# 直近のレスポンスから得た GitHub のレートリミット状況
+# 複数スレッドから読み書きするため、残り回数とリセット時刻は必ずロックを取って組で更新・参照する
+rate_limit_state = {"remaining": None, "reset": 0}
+rate_limit_lock = threading.Lock()
+
+
+@dataclass(frozen=True, slots=True)
 class Config:
-    def __init__(self, owner_name: str, repo_name: str, target_label: str, webhook_url: str):
-        self.owner_name = owner_name
-        self.repo_name = repo_name
-        self.target_label = target_label
-        self.webhook_url = webhook_url
-        self._validate()
-
-    def _validate(self):
+    owner_name: str
+    repo_name: str
+    target_label: str
+    webhook_url: str
+
+    # 設定は起動時に一度だけ読み込まれるため、検証はここでまとめて行う
+    def __post_init__(self):
         if not all([self.owner_name, self.repo_name, self.target_label, self.webhook_url]):
             raise ValueError("All Config fields must be non-empty")
 
+# GitHub API のスキーマで形が保証されたデータから大量に生成されるため、PR ごとの検証は行わない
+@dataclass(frozen=True, slots=True)
 class PullRequest:
-    def __init__(self, assignee_id: str, url: str, html_url: str, is_draft: bool, label_names: List[str]):
-        self.assignee_id = assignee_id
-        self.url = url
-        self.html_url = html_url
-        self.is_draft = is_draft
-        self.label_names = label_names
-        self._validate()
-
-    def _validate(self):
-        if not all([self.assignee_id, self.url, self.html_url, self.label_names]) or self.is_draft is None:
-            raise ValueError("Invalid PullRequest data")
+    author_login: Optional[str]
+    html_url: str
+    # (レビュアーの login, レビュー状態) を古い順に保持する
+    reviews: Tuple[Tuple[str, str], ...]
 
+@dataclass(frozen=True, slots=True)
 class ReviewResult:
-    def __init__(self, pull_request_url: str, reviewed_count: int, approved_count: int, commented_count: int):
-        self.pull_request_url = pull_request_url
-        self.reviewed_count = reviewed_count
-        self.approved_count = approved_count
-        self.commented_count = commented_count
-        self._validate()
-
-    def _validate(self):
+    pull_request_url: str
+    reviewed_count: int
+    approved_count: int
+    commented_count: int
+
+    def __post_init__(self):
         if not self.pull_request_url or self.reviewed_count < 0 or self.approved_count < 0 or self.commented_count < 0:
             raise ValueError("Invalid ReviewResult data")
 
+class CategorizedReviewResults(NamedTuple):
+    waiting: List[ReviewResult]
+    complete: List[ReviewResult]
+
+class LoadedConfigs(NamedTuple):
+    valid: List[Config]
+    invalid_count: int
+
+
+# 同一プロセスで繰り返し読み込む場合に備え、更新時刻が変わらない限り解析結果を使い回す
+# Webhook URL は環境変数から都度解決するため、ここではファイルの内容のみをキャッシュする
+@lru_cache(maxsize=1)
+def read_config_json(file_path: str, mtime_ns: int) -> List[Dict[str, Any]]:
+    config_json_list = orjson.loads(Path(file_path).read_bytes())
+    # Config情報はリスト形式を想定しているため、リストでない場合はエラーを返す
+    if not isinstance(config_json_list, list):
+        raise TypeError("Config file must be a list of objects")
+    return config_json_list
 
-def load_configs(file_path: str = CONFIG_FILE_PATH) -> List[Config]:
+
+def load_configs(file_path: str = CONFIG_FILE_PATH) -> LoadedConfigs:
     logging.info("Loading config file: %s", file_path)
-    path = Path(file_path)
-    if not path.exists():
+    try:
+        mtime_ns = Path(file_path).stat().st_mtime_ns
+    except FileNotFoundError:
         raise FileNotFoundError(f"Config file not found: {file_path}")
     try:
-        with path.open("r", encoding="utf-8") as file:
-            config_json_list = json.load(file)
-            # Config情報はリスト形式を想定しているため、リストでない場合はエラーを返す
-            if not isinstance(config_json_list, list):
-                raise TypeError("Config file must be a list of objects")
-            return [
+        config_json_list = read_config_json(file_path, mtime_ns)
+    except (orjson.JSONDecodeError, TypeError) as e:
+        raise ValueError(f"Invalid config file format: {e}")
+
+    # 不正な設定は 1 件ずつ除外して残りの設定の通知を続け、除外した件数は main で最後に失敗として扱う
+    valid_configs = []
+    for index, config_json in enumerate(config_json_list):
+        if not isinstance(config_json, dict):
+            logging.error("Skipping config #%d: entry must be an object", index)
+            continue
+        try:
+            owner_name, repo_name, target_label, webhook_secret_name = get_config_fields(config_json)
+            valid_configs.append(
                 Config(
-                    owner_name = config_json["owner_name"],
-                    repo_name = config_json["repo_name"],
-                    target_label = config_json["target_label"],
-                    webhook_url = os.getenv(config_json["webhook_secret_name"], "")
+                    owner_name = owner_name,
+                    repo_name = repo_name,
+                    target_label = target_label,
+                    webhook_url = os.environ.get(webhook_secret_name, "")
                 )
-                for config_json in config_json_list
-            ]
-    except (json.JSONDecodeError, TypeError) as e:
-        raise ValueError(f"Invalid config file format: {e}")
+            )
+        except KeyError as e:
+            logging.error("Skipping config #%d: missing required field %s", index, e)
+        except (TypeError, ValueError) as e:
+            logging.error("Skipping config #%d: %s", index, e)
+    return LoadedConfigs(valid_configs, len(config_json_list) - len(valid_configs))
 
 
-def get_pull_request_list(owner_name: str, repo_name: str) -> List[PullRequest]:
-    api_url = f"https://api.github.com/repos/{owner_name}/{repo_name}/pulls"
-    headers = {"Authorization": f"token {DEV_OPS_TOKEN}"}
-    logging.info("Fetching PRs from %s", api_url)
+# GraphQL はレートリミット超過もステータス 200 と RATE_LIMITED エラーで返す
+def is_graphql_rate_limited(response: requests.Response) -> bool:
+    if response.status_code != 200 or response.headers.get("X-RateLimit-Remaining") != "0":
+        return False
     try:
-        response = requests.get(api_url, headers=headers)
-        response.raise_for_status()
-        return [
-            PullRequest(
-                assignee_id=pr["user"]["id"] if pr["user"] else None,
-                url=pr["url"],
-                html_url=pr["html_url"],
-                is_draft=pr.get("draft", False),
-                label_names=[label["name"] for label in pr.get("labels", [])]
+        errors = orjson.loads(response.content).get("errors") or []
+    except (orjson.JSONDecodeError, AttributeError):
+        return False
+    return any(error.get("type") == "RATE_LIMITED" for error in errors)
+
+
+# レートリミットで拒否されたレスポンスから再試行までの待機秒数を求める (再試行しない場合は None)
+def get_rate_limit_wait_seconds(response: requests.Response, retries: int) -> Optional[float]:
+    if response.status_code not in (403, 429) and not is_graphql_rate_limited(response):
+        return None
+    retry_after = response.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+        # Retry-After は秒数のほか HTTP-date 形式の場合もある
+        try:
+            return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 1)
+        except (TypeError, ValueError):
+            logging.warning("Ignoring unparsable Retry-After header: %s", retry_after)
+    if response.headers.get("X-RateLimit-Remaining") == "0":
+        return max(int(response.headers["X-RateLimit-Reset"]) - time.time(), 1)
+    if response.status_code == 429:
+        return min(2 ** retries, 60)
+    # レートリミット以外の 403 (権限不足など) は再試行しても結果が変わらない
+    return None
+
+
+def wait_for_rate_limit_reset():
+    with rate_limit_lock:
+        remaining, reset = rate_limit_state["remaining"], rate_limit_state["reset"]
+    if remaining is None or remaining >= RATE_LIMIT_REMAINING_THRESHOLD:
+        return
+    wait_seconds = reset - time.time()
+    if 0 < wait_seconds <= RATE_LIMIT_MAX_WAIT_SECONDS:
+        logging.warning("GitHub rate limit nearly exhausted (%d left), waiting %.0f seconds", remaining, wait_seconds)
+        time.sleep(wait_seconds)
+
+
+def request_github(method: str, url: str, **kwargs: Any) -> requests.Response:
+    for retries in range(RATE_LIMIT_RETRY_LIMIT + 1):
+        wait_for_rate_limit_reset()
+        response = SESSION.request(method, url, headers=GITHUB_HEADERS, timeout=REQUEST_TIMEOUT_SECONDS, **kwargs)
+        if "X-RateLimit-Remaining" in response.headers:
+            with rate_limit_lock:
+                rate_limit_state["remaining"] = int(response.headers["X-RateLimit-Remaining"])
+                rate_limit_state["reset"] = int(response.headers["X-RateLimit-Reset"])
+        wait_seconds = get_rate_limit_wait_seconds(response, retries)
+        if wait_seconds is None or wait_seconds > RATE_LIMIT_MAX_WAIT_SECONDS or retries == RATE_LIMIT_RETRY_LIMIT:
+            break
+        logging.warning("Rate limited by GitHub, retrying in %.0f seconds: %s", wait_seconds, url)
+        time.sleep(wait_seconds)
+    response.raise_for_status()
+    return response
+
+
+def get_pull_request_list(owner_name: str, repo_name: str, label: str) -> List[PullRequest]:
+    logging.info("Fetching PRs from %s/%s (label: %s)", owner_name, repo_name, label)
+    variables = {"owner": owner_name, "name": repo_name, "label": label, "cursor": None}
+    pull_request_list = []
+    try:
+        while True:
+            response = request_github("POST", GITHUB_GRAPHQL_URL, data=orjson.dumps({"query": PULL_REQUESTS_QUERY, "variables": variables}))
+            response_json = orjson.loads(response.content)
+            # GraphQL はクエリのエラーもステータス 200 で返すため、本文で判定する
+            if response_json.get("errors"):
+                raise ValueError(f"GraphQL query failed: {response_json['errors']}")
+            pull_requests = response_json["data"]["repository"]["pullRequests"]
+            # ドラフトの PR は通知対象外のため、オブジェクトを生成する前に除外する
+            pull_request_list.extend(
+                PullRequest(
+                    author_login=pr["author"]["login"] if pr["author"] else None,
+                    html_url=pr["url"],
+                    reviews=tuple(
+                        (review["author"]["login"], review["state"])
+                        for review in pr["reviews"]["nodes"]
+                        if review["author"]
+                    )
+                )
+                for pr in pull_requests["nodes"]
+                if not pr["isDraft"]
             )
-            for pr in response.json()
-        ]
+            if not pull_requests["pageInfo"]["hasNextPage"]:
+                return pull_request_list
+            variables["cursor"] = pull_requests["pageInfo"]["endCursor"]
     except requests.RequestException as e:
-        logging.error("Failed to fetch PRs: %s", e, exc_info=True)
+        logging.warning("Failed to fetch PRs: %s", e)
         raise
 
 
-def filter_pull_request(pull_request_list: List[PullRequest], label: str) -> List[PullRequest]:
-    return [pr for pr in pull_request_list if label in pr.label_names and not pr.is_draft]
-
-
-def get_review_result(pull_request_list: List[PullRequest]) -> Dict[str, List[ReviewResult]]:
+def get_review_result(pull_request_list: List[PullRequest]) -> CategorizedReviewResults:
     waiting_prs, complete_prs = [], []
     for pr in pull_request_list:
         review_result = get_review_counts(pr)
@@ -113,70 +281,86 @@ def get_review_result(pull_request_list: List[PullRequest]) -> Dict[str, List[Re
             waiting_prs.append(review_result)
         else:
             complete_prs.append(review_result)
-    return {REVIEW_STATUS_WAITING: waiting_prs, REVIEW_STATUS_COMPLETE: complete_prs}
+    return CategorizedReviewResults(waiting_prs, complete_prs)
 
 
 def get_review_counts(pr: PullRequest) -> ReviewResult:
-    api_url = f"{pr.url}/reviews"
-    headers = {"Authorization": f"token {DEV_OPS_TOKEN}"}
-    try:
-        response = requests.get(api_url, headers=headers)
-        response.raise_for_status()
-        
-        reviews = response.json()
-        latest_review_state = {}
+    latest_review_state = {}
 
-        for review in reviews:
-            user_id = review["user"]["id"]
-            if user_id == pr.assignee_id:
-                continue
-            latest_review_state[user_id] = review["state"]
+    for reviewer_login, state in pr.reviews:
+        if reviewer_login == pr.author_login:
+            continue
+        latest_review_state[reviewer_login] = state
 
-        approved_users = {user_id for user_id, state in latest_review_state.items() if state == "APPROVED"}
-        commented_users = {user_id for user_id, state in latest_review_state.items() if state == "COMMENTED"}
+    # レビュアーごとの最新状態は一意なので、状態ごとの件数がそのまま人数になる
+    state_counts = Counter(latest_review_state.values())
 
-        return ReviewResult(pr.html_url, len(latest_review_state), len(approved_users), len(commented_users))
-    except requests.RequestException as e:
-        logging.error("Failed to fetch reviews: %s", e)
-        raise
+    return ReviewResult(pr.html_url, len(latest_review_state), state_counts["APPROVED"], state_counts["COMMENTED"])
 
 
 def format_notification_message(review_results: List[ReviewResult]) -> str:
     if not review_results:
         return "なし"
 
-    return "\n".join(f"- <{review_result.pull_request_url}> ( approve: {review_result.approved_count}人, comment: {review_result.commented_count}人 )" for review_result in review_results)
+    return "\n".join([
+        SLACK_PR_LINE_TEMPLATE % (review_result.pull_request_url, review_result.approved_count, review_result.commented_count)
+        for review_result in review_results
+    ])
 
 
 def send_slack_notification(waiting_prs: List[ReviewResult], complete_prs: List[ReviewResult], label: str, webhook_url: str):
     logging.info("Sending notification to Slack")
-    message = (
-        f":page_facing_up: [{label}] プルリクエストレビュー状況\n\n"
-        "------------------------\n"
-        f"*未レビュー ( {len(waiting_prs)} 件 )*\n{format_notification_message(waiting_prs)}\n\n\n"
-        f"*レビュー中 ( {len(complete_prs)} 件 )*\n{format_notification_message(complete_prs)}"
-    )
+    waiting_block = format_notification_message(waiting_prs)
+    complete_block = format_notification_message(complete_prs)
+    message = SLACK_MESSAGE_TEMPLATE % (label, len(waiting_prs), waiting_block, len(complete_prs), complete_block)
     payload = {"text": message}
 
     try:
-        response = requests.post(webhook_url, json=payload, headers={"Content-Type": "application/json"})
+        response = SESSION.post(webhook_url, data=orjson.dumps(payload), headers=SLACK_HEADERS, timeout=REQUEST_TIMEOUT_SECONDS)
         response.raise_for_status()
     except requests.exceptions.RequestException as e:
         logging.error("Failed to send notification: %s", e)
 
 
-def main():
+# 同じリポジトリ・ラベルを対象とする設定 (通知先のチャンネル違いなど) は、PR の取得を 1 回にまとめる
+def group_configs(configs: List[Config]) -> List[List[Config]]:
+    config_groups: Dict[Tuple[str, str, str], List[Config]] = {}
+    for config in configs:
+        config_groups.setdefault((config.owner_name, config.repo_name, config.target_label), []).append(config)
+    return list(config_groups.values())
+
+
+def process_configs(configs: List[Config]):
+    owner_name, repo_name, target_label = configs[0].owner_name, configs[0].repo_name, configs[0].target_label
+    pr_list = get_pull_request_list(owner_name, repo_name, target_label)
+    review_result = get_review_result(pr_list)
+    for config in configs:
+        send_slack_notification(
+            waiting_prs = review_result.waiting,
+            complete_prs = review_result.complete,
+            label = config.target_label,
+            webhook_url = config.webhook_url
+        )
+
+
+def main(config_path: str = CONFIG_FILE_PATH):
     try:
-        for config in load_configs():
-            pr_list = get_pull_request_list(config.owner_name, config.repo_name)
-            filtered_prs = filter_pull_request(pr_list, config.target_label)
-            review_result = get_review_result(filtered_prs)
-            send_slack_notification(
-                waiting_prs = review_result[REVIEW_STATUS_WAITING],
-                complete_prs = review_result[REVIEW_STATUS_COMPLETE],
-                label = config.target_label,
-                webhook_url = config.webhook_url
-            )
+        loaded_configs = load_configs(config_path)
+        configs = loaded_configs.valid
+        config_groups = group_configs(configs)
+        with ThreadPoolExecutor(max_workers=CONFIG_MAX_WORKERS) as executor:
+            futures = [executor.submit(process_configs, config_group) for config_group in config_groups]
+        # 1 つの設定で失敗しても他の設定の通知は止めず、すべて終わってから失敗として終了する
+        failed_count = loaded_configs.invalid_count
+        for config_group, future in zip(config_groups, futures):
+            error = future.exception()
+            if error is not None:
+                config = config_group[0]
+                logging.error("Failed to process %s/%s (label: %s): %s", config.owner_name, config.repo_name, config.target_label, error, exc_info=error)
+                failed_count += len(config_group)
+        if failed_count:
+            logging.error("%d of %d configs failed", failed_count, len(configs) + loaded_configs.invalid_count)
+            sys.exit(1)
     except Exception as e:
         logging.error("An error occurred: %s", e, exc_info=True)
         sys.exit(1)